@@ -3,29 +3,40 @@ import io
 import logging
 import datetime
 import json
-import re
+import hashlib
 import urllib.parse
 import time
+import math
+import operator
+import asyncio
+import random
+import gzip
+import unicodedata
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import Optional, List, Dict, Any
 
-# --- IMPORTACIONES DE GOOGLE AUTH ---
-import google.auth
-import google.auth.transport.requests
-from google.auth import iam
-
-from fastapi import FastAPI, Depends, HTTPException, Request, UploadFile, File, Form, status, Query
+from fastapi import FastAPI, Depends, HTTPException, Request, UploadFile, File, Form, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from pydantic import BaseModel
+import orjson
+from cachetools import TTLCache, LRUCache
+from google.api_core.exceptions import ResourceExhausted, NotFound, FailedPrecondition
 from google.cloud import firestore, storage
+from google.cloud.storage import transfer_manager
 import vertexai
-from vertexai.generative_models import GenerativeModel
+from vertexai.generative_models import GenerativeModel, GenerationConfig
+from vertexai.language_models import TextEmbeddingModel
 import firebase_admin
 from firebase_admin import auth
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
-from reportlab.lib import colors
 
 # --- CONFIGURACIÓN DE AUDITORÍA ---
 logging.basicConfig(level=logging.INFO)
@@ -33,28 +44,218 @@ logger = logging.getLogger("SIIS-SPT-SERVER")
 
 # --- VARIABLES DE ENTORNO ---
 PROJECT_ID = os.getenv("GCP_PROJECT_ID", "siis-stp")
-APP_ID = "siis-spt-cr"
+APP_ID = os.getenv("APP_ID", "siis-spt-cr")
 BUCKET_NAME = os.getenv("STORAGE_BUCKET_NAME", f"{PROJECT_ID}.firebasestorage.app")
 MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash")
-LOCATION = "us-central1"
+# Parámetros de generación opcionales: sin valor se usan los del modelo
+GEMINI_TEMPERATURE = os.getenv("GEMINI_TEMPERATURE")
+GEMINI_MAX_OUTPUT_TOKENS = os.getenv("GEMINI_MAX_OUTPUT_TOKENS")
+# Recurso CachedContent de Vertex (projects/.../cachedContents/...) con el contexto extenso del MNPT.
+# Se crea y renueva fuera del servicio: la caché explícita exige un mínimo de tokens
+GEMINI_CACHED_CONTENT = os.getenv("GEMINI_CACHED_CONTENT")
+# Llamadas a Gemini en vuelo por worker y reintentos ante cuota agotada (429)
+GEMINI_MAX_CONC = int(os.getenv("GEMINI_MAX_CONC", "48"))
+# Número total de intentos: al menos uno aunque la variable venga en 0
+GEMINI_RETRIES = max(1, int(os.getenv("GEMINI_RETRIES", "4")))
+LOCATION = os.getenv("GCP_LOCATION", "us-central1")
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))
+RECS_CACHE_TTL = int(os.getenv("RECS_CACHE_TTL", "30"))
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "2048"))
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-004")
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "128"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# Vigencia de los análisis persistidos en Firestore (sobreviven reinicios y despliegues)
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600)))
+# Tamaño de cada bloque en subidas reanudables (múltiplo de 256 KiB)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+# A partir de este tamaño la evidencia se sube en partes paralelas (XML multipart)
+PARALLEL_UPLOAD_THRESHOLD = int(os.getenv("PARALLEL_UPLOAD_THRESHOLD", str(32 * 1024 * 1024)))
+PARALLEL_UPLOAD_WORKERS = int(os.getenv("PARALLEL_UPLOAD_WORKERS", "8"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+# Máximo de lecturas de Firestore en vuelo por worker (ajustar junto a la concurrencia de Cloud Run)
+FIRESTORE_CONCURRENCY = int(os.getenv("FIRESTORE_CONCURRENCY", "32"))
+# Pares meta/logro evaluados en una sola llamada a Gemini; más allá la latencia crece sin ahorro
+SUGGESTION_BATCH_MAX = 10
+SUGGESTION_CACHE_TTL = int(os.getenv("SUGGESTION_CACHE_TTL", "900"))
+# Orígenes externos autorizados, separados por comas. Sin valor solo se admite el mismo origen:
+# el panel se sirve desde esta app y no necesita CORS
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
+USER_NEGATIVE_CACHE_TTL = int(os.getenv("USER_NEGATIVE_CACHE_TTL", "30"))
+
+# --- PROYECCIONES DE FIRESTORE ---
+# Solo se transfieren los campos que consume cada vista
+RECS_LIST_FIELDS = ["id", "institution", "description", "progress", "status"]
+RECS_PENDING_FIELDS = ["id", "progress"]
+SUBS_PENDING_FIELDS = ["id", "recommendation_id", "submitted_by", "description", "file_path", "timestamp"]
+
+# --- PROMPTS PIDA ---
+# Instrucciones fijas de cada tarea: viajan como system_instruction del modelo,
+# de modo que cada petición solo envía el contenido variable
+ANALYSIS_INSTRUCTION = "PIDA: Analiza barrera institucional para el MNPT."
+SUGGESTION_INSTRUCTION = "Analiza cumplimiento de la meta según el logro reportado."
+
+# --- SERIALIZACIÓN JSON ---
+def _json_default(obj: Any) -> Any:
+    # Firestore devuelve DatetimeWithNanoseconds, subclase que orjson no serializa por sí solo
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError
+
+def dumps_json(content: Any) -> bytes:
+    return orjson.dumps(content, default=_json_default)
+
+class OrjsonResponse(JSONResponse):
+    # orjson (Rust) serializa listas de dicts varias veces más rápido que json estándar
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_up()
+    yield
 
 # --- CAMBIO VISIBLE PARA VERIFICAR DESPLIEGUE ---
-app = FastAPI(title="VERIFICACION DE DESPLIEGUE V3")
+app = FastAPI(title="VERIFICACION DE DESPLIEGUE V3", default_response_class=OrjsonResponse, lifespan=lifespan)
 
+# El panel se sirve desde esta misma app; CORS solo aplica a orígenes externos declarados.
+# Métodos y encabezados explícitos + max_age permiten al navegador reutilizar el preflight
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
     allow_credentials=True,
+    max_age=86400,
 )
 
+# Compresión de respuestas JSON (listados y análisis PIDA)
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
+# --- MANEJO CENTRALIZADO DE ERRORES ---
+# Los endpoints no capturan excepciones genéricas: cualquier fallo no controlado
+# se registra aquí y se responde como 500 (las HTTPException siguen su curso normal)
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    logger.error(f"Error no controlado en {request.url.path}: {str(exc)}")
+    return OrjsonResponse({"detail": "Error de servidor"}, status_code=500)
+
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
-db = firestore.Client(project=PROJECT_ID)
+# Cliente asíncrono: las lecturas/escrituras de Firestore no bloquean el event loop
+db = firestore.AsyncClient(project=PROJECT_ID)
 storage_client = storage.Client(project=PROJECT_ID)
+# Rutas de colección fijas durante la vida del proceso: se construyen una sola vez
+RECS_COLL = db.collection("artifacts").document(APP_ID).collection("public").document("data").collection("recommendations")
+SUBS_COLL = db.collection("artifacts").document(APP_ID).collection("submissions")
+USERS_COLL = db.collection("artifacts").document(APP_ID).collection("users")
+AI_CACHE_COLL = db.collection("artifacts").document(APP_ID).collection("ai_cache")
+# Acota las lecturas simultáneas: ante ráfagas las peticiones esperan aquí en lugar de
+# agotar los streams gRPC o la cuota y provocar timeouts en cascada
+FIRESTORE_SEM = asyncio.Semaphore(FIRESTORE_CONCURRENCY)
 vertexai.init(project=PROJECT_ID, location=LOCATION)
+# Una instancia por tarea, compartida por todas las peticiones
+# La configuración de generación se fija una vez en el modelo, no en cada llamada
+GENERATION_PARAMS = dict(
+    temperature=float(GEMINI_TEMPERATURE) if GEMINI_TEMPERATURE else None,
+    max_output_tokens=int(GEMINI_MAX_OUTPUT_TOKENS) if GEMINI_MAX_OUTPUT_TOKENS else None,
+)
+GENERATION_CONFIG = GenerationConfig(**GENERATION_PARAMS)
+# Salida estructurada para las sugerencias: Gemini devuelve JSON válido según el esquema
+SUGGESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "percentage": {"type": "integer"},
+        "justification": {"type": "string"},
+    },
+    "required": ["percentage", "justification"],
+}
+SUGGESTION_CONFIG = GenerationConfig(
+    **GENERATION_PARAMS, response_mime_type="application/json", response_schema=SUGGESTION_SCHEMA
+)
+SUGGESTION_BATCH_CONFIG = GenerationConfig(
+    **GENERATION_PARAMS,
+    response_mime_type="application/json",
+    response_schema={
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"index": {"type": "integer"}, **SUGGESTION_SCHEMA["properties"]},
+            "required": ["index", *SUGGESTION_SCHEMA["required"]],
+        },
+    },
+)
+ANALYSIS_MODEL = GenerativeModel(
+    MODEL_NAME, system_instruction=ANALYSIS_INSTRUCTION, generation_config=GENERATION_CONFIG
+)
+SUGGESTION_MODEL = GenerativeModel(
+    MODEL_NAME, system_instruction=SUGGESTION_INSTRUCTION, generation_config=SUGGESTION_CONFIG
+)
+# Identifica el contexto del modelo de análisis en las claves de caché PIDA
+ANALYSIS_SCOPE = f"{MODEL_NAME}\n{ANALYSIS_INSTRUCTION}"
+
+# Par (modelo, alcance) vigente para el análisis. Se sustituye como una sola tupla:
+# cada petición toma un par coherente aunque el cambio ocurra a mitad de camino
+_analysis_target = (ANALYSIS_MODEL, ANALYSIS_SCOPE)
+
+# Errores de un CachedContent vencido o borrado en Vertex
+CACHED_CONTENT_ERRORS = (NotFound, FailedPrecondition)
+
+def use_cached_content():
+    # from_cached_content consulta el recurso en Vertex: se resuelve al arrancar, no al importar.
+    # El CachedContent debe crearse con ANALYSIS_INSTRUCTION como system_instruction
+    global _analysis_target
+    model = GenerativeModel.from_cached_content(GEMINI_CACHED_CONTENT, generation_config=GENERATION_CONFIG)
+    _analysis_target = (model, f"{MODEL_NAME}\n{GEMINI_CACHED_CONTENT}")
+
+def drop_cached_content(error: Exception):
+    # Vuelve al modelo con system_instruction hasta el próximo despliegue
+    global _analysis_target
+    if _analysis_target[0] is not ANALYSIS_MODEL:
+        logger.error(f"CachedContent no disponible, se usa el modelo con instrucciones: {str(error)}")
+        _analysis_target = (ANALYSIS_MODEL, ANALYSIS_SCOPE)
+
+LLM_SEM = asyncio.Semaphore(GEMINI_MAX_CONC)
+
+async def _quota_backoff(attempt: int):
+    delay = min(2 ** attempt, 16) * (0.5 + random.random())
+    logger.warning(f"Cuota de Gemini agotada, reintento {attempt + 1} en {delay:.1f}s")
+    await asyncio.sleep(delay)
+
+async def generate_content(model: GenerativeModel, prompt: str, **kwargs):
+    """
+    Llamada a Gemini acotada por LLM_SEM. Ante un 429 reintenta con espera
+    exponencial y jitter.
+    """
+    for attempt in range(GEMINI_RETRIES):
+        try:
+            async with LLM_SEM:
+                return await model.generate_content_async(prompt, **kwargs)
+        except ResourceExhausted:
+            if attempt == GEMINI_RETRIES - 1:
+                raise
+            await _quota_backoff(attempt)
+
+async def stream_content(model: GenerativeModel, prompt: str):
+    """
+    Versión en stream de generate_content: LLM_SEM se retiene hasta consumir
+    el flujo completo. Un 429 se reintenta mientras no se haya emitido texto;
+    después ya no es posible y se propaga a quien consume el generador.
+    """
+    for attempt in range(GEMINI_RETRIES):
+        emitted = False
+        try:
+            async with LLM_SEM:
+                responses = await model.generate_content_async(prompt, stream=True)
+                async for chunk in responses:
+                    emitted = True
+                    yield chunk.text
+            return
+        except ResourceExhausted:
+            if emitted or attempt == GEMINI_RETRIES - 1:
+                raise
+            await _quota_backoff(attempt)
 
 # --- MODELOS DE DATOS ---
 class BarrierInput(BaseModel):
@@ -69,28 +270,250 @@ class SuggestionInput(BaseModel):
     recommendation_id: str
 
 # --- MIDDLEWARE DE SEGURIDAD ---
+def is_admin_profile(user_data: Dict[str, Any]) -> bool:
+    return user_data.get("role") == "admin" or user_data.get("inst_slug") == "all"
+
+# Errores de un token inválido, vencido, revocado o de usuario deshabilitado (401).
+# Cualquier otro fallo (Firestore, certificados) llega al manejador global como 500
+AUTH_ERRORS = (ValueError, auth.InvalidIdTokenError, auth.UserDisabledError)
+
+# Caché de tokens ya verificados: evita repetir la verificación de firma en cada petición
+_token_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+
+async def verify_token(token: str) -> Dict[str, Any]:
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    decoded_token = _token_cache.get(key)
+    # Nunca se sirve un token desde caché más allá de su propio 'exp'
+    if decoded_token is not None and decoded_token.get("exp", 0) > time.time():
+        return decoded_token
+
+    # verify_id_token es bloqueante (descarga de certificados + firma RSA)
+    decoded_token = await run_in_threadpool(auth.verify_id_token, token)
+    _token_cache[key] = decoded_token
+    return decoded_token
+
+# Perfiles de usuario por email: evita leer users/{email} en cada petición.
+# Los correos no registrados se recuerdan menos tiempo para que un alta se note pronto
+_user_cache = TTLCache(maxsize=4096, ttl=USER_CACHE_TTL)
+_unknown_user_cache = TTLCache(maxsize=4096, ttl=USER_NEGATIVE_CACHE_TTL)
+
+# Lecturas de perfil en curso: las peticiones simultáneas de un mismo correo comparten una RPC
+_user_fetches: Dict[str, asyncio.Future] = {}
+
+async def _fetch_user_profile(email: str) -> Optional[Dict[str, Any]]:
+    async with FIRESTORE_SEM:
+        user_doc = await USERS_COLL.document(email).get()
+    if not user_doc.exists:
+        _unknown_user_cache[email] = True
+        return None
+    user_data = user_doc.to_dict()
+    user_data["is_admin"] = is_admin_profile(user_data)
+    _user_cache[email] = user_data
+    return user_data
+
+async def get_user_profile(email: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not email or email in _unknown_user_cache:
+        return None
+    user_data = _user_cache.get(email)
+    if user_data is not None:
+        return user_data
+
+    fetch = _user_fetches.get(email)
+    if fetch is None:
+        fetch = asyncio.ensure_future(_fetch_user_profile(email))
+        _user_fetches[email] = fetch
+        fetch.add_done_callback(lambda _: _user_fetches.pop(email, None))
+    # shield: si una petición se cancela, la lectura compartida sigue para las demás
+    return await asyncio.shield(fetch)
+
+# Campos del perfil que se copian como custom claims de Firebase (/api/admin/sync-claims)
+CLAIM_FIELDS = ("role", "inst_slug", "institution")
+
+async def user_from_token(decoded_token: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Con custom claims el token ya trae rol e institución: no hace falta leer Firestore
+    if "role" in decoded_token or "inst_slug" in decoded_token:
+        user_data = {"email": decoded_token.get("email")}
+        user_data.update({f: decoded_token[f] for f in CLAIM_FIELDS if f in decoded_token})
+        user_data["is_admin"] = is_admin_profile(user_data)
+        if not user_data["is_admin"]:
+            return user_data
+        # El rol de administrador nunca se acepta solo por el claim: se confirma contra el
+        # perfil de Firestore (cacheado). Un admin degradado recibe su perfil actual
+        profile = await get_user_profile(decoded_token.get("email"))
+        return user_data if profile is not None and profile["is_admin"] else profile
+    return await get_user_profile(decoded_token.get("email"))
+
 async def get_current_user(request: Request) -> Dict[str, Any]:
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="No autorizado")
     
-    token = auth_header.split("Bearer ")[1]
+    token = auth_header[7:]  # len("Bearer "), ya validado por startswith
     try:
-        decoded_token = auth.verify_id_token(token)
-        email = decoded_token.get("email")
-        
-        user_ref = db.collection("artifacts").document(APP_ID).collection("users").document(email)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            raise HTTPException(status_code=403, detail="Usuario no registrado en Firestore")
-            
-        user_data = user_doc.to_dict()
-        user_data["is_admin"] = user_data.get("role") == "admin" or user_data.get("inst_slug") == "all"
-        return user_data
-    except Exception as e:
+        decoded_token = await verify_token(token)
+    except AUTH_ERRORS as e:
         logger.error(f"Error de Auth: {str(e)}")
         raise HTTPException(status_code=401, detail="Token inválido")
+    user_data = await user_from_token(decoded_token)
+    if user_data is None:
+        raise HTTPException(status_code=403, detail="Usuario no registrado en Firestore")
+    return user_data
+
+async def get_admin_user(user=Depends(get_current_user)) -> Dict[str, Any]:
+    # Rechaza a los no administradores antes de ejecutar el endpoint
+    # (is_admin ya viene confirmado contra Firestore por user_from_token)
+    if not user["is_admin"]:
+        raise HTTPException(status_code=403)
+    return user
+
+# --- CACHÉ DE RECOMENDACIONES ---
+def fold_text(value: Optional[str]) -> str:
+    # Minúsculas y sin tildes: "Educación" y "educacion" deben coincidir al filtrar por institución
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+# La colección solo cambia al aprobar evidencias: se sirve desde memoria durante RECS_CACHE_TTL
+_recs_cache = TTLCache(maxsize=1, ttl=RECS_CACHE_TTL)
+
+# Al expirar la caché, solo la primera petición consulta Firestore; las concurrentes esperan su resultado
+_recs_lock = asyncio.Lock()
+
+async def _load_recommendations() -> Dict[str, Any]:
+    entry = _recs_cache.get("all")
+    if entry is not None:
+        return entry
+    async with _recs_lock:
+        entry = _recs_cache.get("all")
+        if entry is None:
+            items = [{"firestore_doc_id": doc.id, **doc.to_dict()} async for doc in RECS_COLL.select(RECS_LIST_FIELDS).stream()]
+            all_json = dumps_json(items)
+            entry = {
+                "items": items,
+                # Huella del contenido: igual en todos los workers mientras los datos no cambien
+                "version": hashlib.blake2b(all_json, digest_size=16).hexdigest(),
+                # JSON ya serializado por alcance ("all" o "slug:<slug>"), se completa bajo demanda
+                "payloads": {"all": all_json},
+                # Las mismas cargas comprimidas con gzip, para clientes que lo aceptan
+                "gzip_payloads": {},
+                # Institución normalizada (fold_text) una vez por recarga, no por petición
+                "institution_lc": [fold_text(r.get("institution")) for r in items],
+            }
+            _recs_cache["all"] = entry
+    return entry
+
+def recommendations_payload(entry: Dict[str, Any], slug: Optional[str], use_gzip: bool = False) -> bytes:
+    # Cada lista se filtra, serializa y comprime una sola vez por versión de los datos
+    scope = "all" if slug is None else f"slug:{slug}"
+    payload = entry["payloads"].get(scope)
+    if payload is None:
+        recs = [r for r, inst in zip(entry["items"], entry["institution_lc"]) if slug in inst]
+        payload = dumps_json(recs)
+        entry["payloads"][scope] = payload
+    if not use_gzip:
+        return payload
+    compressed = entry["gzip_payloads"].get(scope)
+    if compressed is None:
+        compressed = gzip.compress(payload, compresslevel=6)
+        entry["gzip_payloads"][scope] = compressed
+    return compressed
+
+# --- CACHÉ DE ANÁLISIS PIDA ---
+# Primer nivel: coincidencia exacta del prompt (O(1), sin llamada de embedding)
+_analysis_cache = LRUCache(maxsize=ANALYSIS_CACHE_SIZE)
+
+def prompt_key(prompt: str) -> bytes:
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+
+# Segundo nivel: barreras casi idénticas reutilizan el análisis ya generado (similitud coseno sobre embeddings)
+_semantic_cache: deque = deque(maxlen=SEMANTIC_CACHE_SIZE)
+
+@lru_cache(maxsize=1)
+def get_embedding_model() -> TextEmbeddingModel:
+    # from_pretrained consulta el registro de modelos: se construye una sola vez y bajo demanda
+    return TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME)
+
+async def embed_text(text: str) -> Optional[List[float]]:
+    try:
+        model = await run_in_threadpool(get_embedding_model)
+        embeddings = await model.get_embeddings_async([text])
+        values = embeddings[0].values
+        norm = math.sqrt(sum(v * v for v in values)) or 1.0
+        return [v / norm for v in values]
+    except Exception as e:
+        # Sin embedding se consulta directamente al modelo
+        logger.warning(f"Caché semántica no disponible: {str(e)}")
+        return None
+
+# Tercer nivel: análisis persistidos en Firestore, compartidos entre instancias.
+# El campo expires_at admite una política TTL de Firestore para purgar entradas vencidas
+async def persisted_analysis_lookup(key: bytes) -> Optional[str]:
+    try:
+        async with FIRESTORE_SEM:
+            doc = await AI_CACHE_COLL.document(key.hex()).get()
+    except Exception as e:
+        logger.warning(f"Caché persistente no disponible: {str(e)}")
+        return None
+    if not doc.exists:
+        return None
+    data = doc.to_dict()
+    expires_at = data.get("expires_at")
+    if expires_at is None or expires_at.timestamp() <= time.time():
+        return None
+    return data.get("analysis")
+
+async def persist_analysis(key: bytes, result: Dict[str, str]):
+    # Se ejecuta después de cerrar el flujo; 'result' queda vacío si Gemini falló
+    analysis = result.get("analysis")
+    if not analysis:
+        return
+    try:
+        await AI_CACHE_COLL.document(key.hex()).set({
+            "analysis": analysis,
+            "model": MODEL_NAME,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "expires_at": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=AI_CACHE_TTL),
+        })
+    except Exception as e:
+        logger.error(f"Error persistiendo análisis PIDA: {str(e)}")
+
+def semantic_cache_lookup(vector: List[float], scope: str) -> Optional[str]:
+    best_score, best_text = 0.0, None
+    for cached_scope, cached_vector, cached_text in _semantic_cache:
+        # Solo análisis generados con el mismo modelo y contexto
+        if cached_scope != scope:
+            continue
+        # map(operator.mul) recorre ambos vectores en C, sin una tupla por componente
+        score = sum(map(operator.mul, vector, cached_vector))
+        if score > best_score:
+            best_score, best_text = score, cached_text
+    return best_text if best_score >= SEMANTIC_CACHE_THRESHOLD else None
+
+# --- PRECALENTAMIENTO ---
+async def warm_up():
+    """
+    Abre los canales de Firestore, Storage y Vertex antes de la primera petición
+    (handshake TLS/HTTP2 y credenciales) y deja cargada la caché de recomendaciones.
+    Un fallo aquí solo se registra: el servicio arranca igual.
+    """
+    steps = {
+        "firestore": _load_recommendations(),
+        "storage": run_in_threadpool(storage_client.bucket(BUCKET_NAME).exists),
+        "embeddings": run_in_threadpool(get_embedding_model),
+    }
+    if GEMINI_CACHED_CONTENT:
+        # Si falla se sigue usando el modelo con system_instruction
+        steps["cached_content"] = run_in_threadpool(use_cached_content)
+    try:
+        # Acotado: un backend lento no debe retrasar el arranque de la instancia
+        results = await asyncio.wait_for(
+            asyncio.gather(*steps.values(), return_exceptions=True), timeout=WARMUP_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Precalentamiento incompleto tras {WARMUP_TIMEOUT}s")
+        return
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Precalentamiento de {name} fallido: {str(result)}")
 
 # --- API ENDPOINTS ---
 
@@ -103,210 +526,538 @@ async def auth_me(user=Depends(get_current_user)):
         "role": user.get("role")
     }
 
+def cache_headers(version: str, scope: str) -> Dict[str, str]:
+    # El navegador revalida siempre (no-cache): tras una aprobación nunca muestra datos viejos,
+    # pero mientras nada cambie recibe un 304 sin cuerpo
+    etag = hashlib.blake2b(f"{version}:{scope}".encode(), digest_size=16).hexdigest()
+    return {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache", "Vary": "Authorization, Accept-Encoding"}
+
+def not_modified(request: Request, headers: Dict[str, str]) -> Optional[Response]:
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return None
+
 @app.get("/api/recommendations")
-async def list_recommendations(user=Depends(get_current_user)):
-    try:
-        ref = db.collection("artifacts").document(APP_ID).collection("public").document("data").collection("recommendations")
-        docs = ref.stream()
-        all_recs = [{"firestore_doc_id": doc.id, **doc.to_dict()} for doc in docs]
-        
-        if user["is_admin"]:
-            return all_recs
-        
-        slug = user.get("inst_slug", "").lower()
-        return [r for r in all_recs if slug in r.get("institution", "").lower()]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def list_recommendations(request: Request, user=Depends(get_current_user)):
+    entry = await _load_recommendations()
+    slug = None if user["is_admin"] else fold_text(user.get("inst_slug"))
+    headers = cache_headers(entry["version"], "all" if slug is None else f"slug:{slug}")
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    payload = recommendations_payload(entry, slug)
+    # Listas pequeñas no compensan la compresión (mismo umbral que GZipMiddleware)
+    if len(payload) >= 500 and "gzip" in request.headers.get("accept-encoding", ""):
+        # Con Content-Encoding ya fijado, GZipMiddleware deja pasar la respuesta intacta
+        payload = recommendations_payload(entry, slug, use_gzip=True)
+        headers = {**headers, "Content-Encoding": "gzip"}
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+# Sugerencias por contenido de meta y logro: si se edita cualquiera de los dos, cambia la clave
+_suggestion_cache = TTLCache(maxsize=1024, ttl=SUGGESTION_CACHE_TTL)
+
+def suggestion_prompt(meta: str, logro: str) -> str:
+    return f"Meta: '{meta}'. Logro: '{logro}'."
+
+def suggestion_key(prompt: str) -> bytes:
+    return prompt_key(f"{MODEL_NAME}\n{SUGGESTION_INSTRUCTION}\n{prompt}")
 
 @app.post("/api/admin/suggest-progress")
-async def suggest_progress(data: SuggestionInput, user=Depends(get_current_user)):
-    if not user["is_admin"]:
-        raise HTTPException(status_code=403)
-    try:
-        rec_doc = db.collection("artifacts").document(APP_ID).collection("public").document("data").collection("recommendations").document(data.recommendation_id).get()
-        sub_doc = db.collection("artifacts").document(APP_ID).collection("submissions").document(data.submission_id).get()
-        
-        meta = rec_doc.to_dict().get("description", "")
-        logro = sub_doc.to_dict().get("description", "")
-
-        model = GenerativeModel(MODEL_NAME)
-        prompt = f"Analiza cumplimiento. Meta: '{meta}'. Logro: '{logro}'. Responde JSON: {{'percentage': int, 'justification': str}}"
-        response = model.generate_content(prompt)
-        match = re.search(r'\{.*\}', response.text, re.DOTALL)
-        return json.loads(match.group())
-    except Exception as e:
-        logger.error(f"Fallo IA PIDA: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error en el motor")
+async def suggest_progress(data: SuggestionInput, user=Depends(get_admin_user)):
+    # Las dos lecturas son independientes: en paralelo la latencia es la de la más lenta
+    async with FIRESTORE_SEM:
+        rec_doc, sub_doc = await asyncio.gather(
+            RECS_COLL.document(data.recommendation_id).get(),
+            SUBS_COLL.document(data.submission_id).get(),
+        )
+    
+    meta = rec_doc.to_dict().get("description", "")
+    logro = sub_doc.to_dict().get("description", "")
+
+    prompt = suggestion_prompt(meta, logro)
+    key = suggestion_key(prompt)
+    cached = _suggestion_cache.get(key)
+    if cached is not None:
+        return cached
+    response = await generate_content(SUGGESTION_MODEL, prompt)
+    suggestion = json.loads(response.text)
+    _suggestion_cache[key] = suggestion
+    return suggestion
+
+@app.post("/api/admin/suggest-progress/batch")
+async def suggest_progress_batch(items: List[SuggestionInput], user=Depends(get_admin_user)):
+    """
+    Evalúa varias evidencias en una sola llamada a Gemini. Devuelve una lista
+    en el mismo orden que la entrada.
+    """
+    if not items or len(items) > SUGGESTION_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Se admiten entre 1 y {SUGGESTION_BATCH_MAX} evidencias")
+
+    async def read_all(coll, ids):
+        return {snap.id: snap.to_dict() or {} async for snap in db.get_all([coll.document(i) for i in set(ids)])}
+
+    async with FIRESTORE_SEM:
+        recs, subs = await asyncio.gather(
+            read_all(RECS_COLL, [i.recommendation_id for i in items]),
+            read_all(SUBS_COLL, [i.submission_id for i in items]),
+        )
+
+    # Cada par usa la misma clave que el endpoint individual: los aciertos no van a Gemini
+    # y los veredictos nuevos sirven también a /api/admin/suggest-progress
+    pairs = [
+        (recs.get(i.recommendation_id, {}).get("description", ""), subs.get(i.submission_id, {}).get("description", ""))
+        for i in items
+    ]
+    keys = [suggestion_key(suggestion_prompt(meta, logro)) for meta, logro in pairs]
+    suggestions = [_suggestion_cache.get(key) for key in keys]
+    missing = [n for n, suggestion in enumerate(suggestions) if suggestion is None]
+
+    if missing:
+        rows = [f"{n}. {suggestion_prompt(*pairs[n])}" for n in missing]
+        prompt = (
+            f"Evalúa los siguientes {len(missing)} pares de meta y logro. "
+            "Devuelve un veredicto por par con su número en 'index'.\n"
+            + "\n".join(rows)
+        )
+        response = await generate_content(SUGGESTION_MODEL, prompt, generation_config=SUGGESTION_BATCH_CONFIG)
+        verdicts = {v.get("index"): v for v in json.loads(response.text)}
+        for n in missing:
+            verdict = verdicts.get(n)
+            if verdict is None or verdict.get("percentage") is None:
+                continue
+            suggestions[n] = {"percentage": verdict["percentage"], "justification": verdict.get("justification", "")}
+            _suggestion_cache[keys[n]] = suggestions[n]
+
+    return [
+        {
+            "submission_id": i.submission_id,
+            "percentage": (suggestion or {}).get("percentage"),
+            "justification": (suggestion or {}).get("justification", ""),
+        }
+        for i, suggestion in zip(items, suggestions)
+    ]
+
+# Se añade al cuerpo cuando el stream de Gemini falla después de enviar texto
+STREAM_ERROR_MARKER = "\n\n[ERROR] El análisis se interrumpió antes de terminar. Intente de nuevo."
 
 @app.post("/api/ai/analyze")
 async def analyze_barrier(data: BarrierInput, user=Depends(get_current_user)):
+    """
+    El análisis se transmite a medida que Gemini genera el texto, de modo que
+    el cliente ve los primeros párrafos sin esperar la respuesta completa.
+    """
+    prompt = data.text
+    # Espacios y saltos de línea extra no cambian la barrera: no deben fallar la caché exacta
+    normalized = " ".join(prompt.split())
+    # La clave incluye modelo y contexto (scope): al cambiar cualquiera, las entradas persistidas dejan de coincidir
+    model, scope = _analysis_target
+    key = prompt_key(f"{scope}\n{normalized}")
+    cached = _analysis_cache.get(key)
+    if cached is not None:
+        return StreamingResponse(iter([cached]), media_type="text/plain; charset=utf-8")
+
+    cached = await persisted_analysis_lookup(key)
+    if cached is not None:
+        _analysis_cache[key] = cached
+        return StreamingResponse(iter([cached]), media_type="text/plain; charset=utf-8")
+
+    vector = await embed_text(data.text)
+    if vector:
+        cached = semantic_cache_lookup(vector, scope)
+        if cached is not None:
+            _analysis_cache[key] = cached
+            return StreamingResponse(iter([cached]), media_type="text/plain; charset=utf-8")
+
+    chunks = stream_content(model, prompt)
+    # El primer fragmento se espera antes de responder: un fallo al abrir el flujo
+    # (cuota agotada tras los reintentos, modelo no disponible) llega como error HTTP
     try:
-        model = GenerativeModel(MODEL_NAME)
-        prompt = f"PIDA: Analiza barrera institucional para el MNPT: {data.text}"
-        response = model.generate_content(prompt)
-        return {"analysis": response.text}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        first = await anext(chunks, "")
+    except CACHED_CONTENT_ERRORS as e:
+        if model is ANALYSIS_MODEL:
+            raise
+        # CachedContent vencido o borrado: se reintenta con el modelo con instrucciones
+        drop_cached_content(e)
+        model, scope = _analysis_target
+        key = prompt_key(f"{scope}\n{normalized}")
+        chunks = stream_content(model, prompt)
+        first = await anext(chunks, "")
+    result: Dict[str, str] = {}
+
+    async def stream_analysis():
+        parts = [first]
+        yield first
+        try:
+            async for text in chunks:
+                parts.append(text)
+                yield text
+        except Exception as e:
+            # Los encabezados ya se enviaron: se avisa al cliente en el propio cuerpo
+            # y el texto parcial no se guarda en ninguna caché
+            logger.error(f"Fallo IA PIDA (stream): {str(e)}")
+            yield STREAM_ERROR_MARKER
+            return
+        analysis = "".join(parts)
+        _analysis_cache[key] = analysis
+        if vector:
+            _semantic_cache.append((scope, vector, analysis))
+        result["analysis"] = analysis
+
+    return StreamingResponse(
+        stream_analysis(),
+        media_type="text/plain; charset=utf-8",
+        background=BackgroundTask(persist_analysis, key, result),
+    )
+
+def spooled_file_path(file_obj) -> Optional[str]:
+    # Ruta en disco del archivo de la subida, si Starlette ya lo volcó a disco.
+    # TemporaryFile no tiene nombre: se abre por su descriptor en /proc, sin copiarlo
+    name = getattr(file_obj, "name", None)
+    if isinstance(name, int):
+        name = f"/proc/self/fd/{name}"
+    return name if isinstance(name, str) and os.path.exists(name) else None
+
+def upload_blob(blob: storage.Blob, file_obj, size: Optional[int], content_type: Optional[str]):
+    path = spooled_file_path(file_obj)
+    if size is None or size < PARALLEL_UPLOAD_THRESHOLD or path is None:
+        # Con 'size' conocido el cliente no necesita bufferizar el archivo para medirlo:
+        # subida multipart directa en archivos pequeños y reanudable por bloques en el resto
+        blob.upload_from_file(file_obj, content_type=content_type, size=size)
+        return
+    # transfer_manager lee las partes directamente del archivo de la subida: una copia
+    # duplicaría su tamaño en memoria (en Cloud Run /tmp vive en RAM)
+    transfer_manager.upload_chunks_concurrently(
+        path, blob,
+        content_type=content_type,
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        worker_type=transfer_manager.THREAD,
+        max_workers=PARALLEL_UPLOAD_WORKERS,
+    )
+
+async def _record_submissions(recommendation_id: str, description: str, file_paths: List[str], email: str):
+    # Se ejecuta con los archivos ya en el bucket y antes de responder: en Cloud Run la CPU
+    # se limita tras enviar la respuesta, y el usuario solo ve éxito si el registro quedó escrito.
+    # Un solo commit por lote (máximo 500 escrituras por WriteBatch) en lugar de un set() por archivo
+    for start in range(0, len(file_paths), 500):
+        chunk = file_paths[start:start + 500]
+        batch = db.batch()
+        for file_path in chunk:
+            sub_ref = SUBS_COLL.document()
+            batch.set(sub_ref, {
+                "id": sub_ref.id,
+                "recommendation_id": recommendation_id, 
+                "submitted_by": email,
+                "description": description,
+                "file_path": file_path,
+                "status": "PENDIENTE",
+                "timestamp": firestore.SERVER_TIMESTAMP
+            })
+        try:
+            async with FIRESTORE_SEM:
+                await batch.commit()
+        except Exception as e:
+            logger.error(f"Error registrando envíos de {email} ({', '.join(chunk)}): {str(e)}")
+            raise HTTPException(status_code=500, detail="Los archivos se subieron pero no se pudo registrar el envío")
 
 @app.post("/api/evidence/upload")
 async def upload_evidence(
     recommendation_id: str = Form(...), 
     description: str = Form(...),
-    file: UploadFile = File(...), 
+    # Uno o varios archivos bajo el mismo campo 'file' (paquete de evidencias)
+    files: List[UploadFile] = File(..., alias="file"), 
     user=Depends(get_current_user)
 ):
-    try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        file_path = f"evidence/{recommendation_id}/{file.filename}"
-        blob = bucket.blob(file_path)
-        blob.upload_from_file(file.file, content_type=file.content_type)
-        
-        sub_ref = db.collection("artifacts").document(APP_ID).collection("submissions").document()
-        sub_ref.set({
-            "id": sub_ref.id,
-            "recommendation_id": recommendation_id, 
-            "submitted_by": user["email"],
-            "description": description,
-            "file_path": file_path,
-            "status": "PENDIENTE",
-            "timestamp": firestore.SERVER_TIMESTAMP
-        })
-        return {"message": "Registro completado"}
-    except Exception as e:
-        logger.error(f"Fallo carga: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    bucket = storage_client.bucket(BUCKET_NAME)
+    file_paths = [f"evidence/{recommendation_id}/{file.filename}" for file in files]
+    # Dos archivos con el mismo nombre irían al mismo objeto del bucket en paralelo
+    if len(set(file_paths)) != len(file_paths):
+        raise HTTPException(status_code=400, detail="El paquete contiene archivos con el mismo nombre")
+
+    # Las subidas son bloqueantes: van al threadpool y en paralelo entre sí.
+    # Sin chunk_size explícito las subidas reanudables envían bloques de 100 MiB,
+    # que el cliente mantiene en memoria: con bloques pequeños la memoria queda acotada
+    await asyncio.gather(*(
+        run_in_threadpool(
+            upload_blob,
+            bucket.blob(file_path, chunk_size=UPLOAD_CHUNK_SIZE),
+            file.file, file.size, file.content_type
+        )
+        for file, file_path in zip(files, file_paths)
+    ))
+    await _record_submissions(recommendation_id, description, file_paths, user["email"])
+    return {"message": "Registro completado"}
 
 # --- PROXY DE DESCARGA ---
 @app.get("/api/evidence/proxy")
 async def download_proxy(path: str, token: str = Query(...)):
     try:
-        decoded_token = auth.verify_id_token(token)
-        email = decoded_token.get("email")
-        
-        user_ref = db.collection("artifacts").document(APP_ID).collection("users").document(email)
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-             raise HTTPException(status_code=403, detail="No autorizado")
-        
-        user_data = user_doc.to_dict()
-        if not (user_data.get("role") == "admin" or user_data.get("inst_slug") == "all"):
-             raise HTTPException(status_code=403, detail="Requiere Admin")
-
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(path)
-        
-        if not blob.exists():
-             logger.error(f"Archivo no encontrado en bucket: {path}")
-             raise HTTPException(status_code=404, detail="Archivo no encontrado")
-
-        file_content = blob.download_as_bytes()
-        file_stream = io.BytesIO(file_content)
-        content_type = blob.content_type or "application/octet-stream"
-        filename = path.split("/")[-1]
-
-        return StreamingResponse(
-            file_stream, 
-            media_type=content_type,
-            headers={"Content-Disposition": f"inline; filename={filename}"}
-        )
-    except Exception as e:
+        decoded_token = await verify_token(token)
+    except AUTH_ERRORS as e:
         logger.error(f"Error Proxy: {str(e)}")
         raise HTTPException(status_code=401, detail="Acceso denegado o error de archivo")
+    user_data = await user_from_token(decoded_token)
+    if user_data is None:
+         raise HTTPException(status_code=403, detail="No autorizado")
+    
+    if not user_data["is_admin"]:
+         raise HTTPException(status_code=403, detail="Requiere Admin")
+
+    bucket = storage_client.bucket(BUCKET_NAME)
+    # El cliente de Storage es síncrono: sus llamadas de red van al threadpool.
+    # get_blob devuelve None si no existe y, en la misma consulta, trae el content_type
+    blob = await run_in_threadpool(bucket.get_blob, path)
+    
+    if blob is None:
+         logger.error(f"Archivo no encontrado en bucket: {path}")
+         raise HTTPException(status_code=404, detail="Archivo no encontrado")
+
+    file_content = await run_in_threadpool(blob.download_as_bytes)
+    file_stream = io.BytesIO(file_content)
+    content_type = blob.content_type or "application/octet-stream"
+    filename = path.split("/")[-1]
+
+    return StreamingResponse(
+        file_stream, 
+        media_type=content_type,
+        headers={"Content-Disposition": f"inline; filename={filename}"}
+    )
 
 @app.get("/api/admin/pending")
-async def list_pending(request: Request, user=Depends(get_current_user)):
+async def list_pending(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    user=Depends(get_admin_user)
+):
     """
     MODIFICADO: Se agrega un parámetro 'v' (timestamp) a la URL generada
     para garantizar que el navegador no reutilice enlaces viejos.
+    La cola se pagina por antigüedad: 'cursor' es el id del último envío recibido.
+    Requiere el índice compuesto (status, timestamp) de firestore.indexes.json.
     """
-    if not user["is_admin"]:
-        raise HTTPException(status_code=403)
-    try:
-        subs_stream = db.collection("artifacts").document(APP_ID).collection("submissions").where("status", "==", "PENDIENTE").stream()
-        results = []
-        
-        # Timestamp actual para romper caché en la URL
-        ts = int(time.time())
-
-        for s in subs_stream:
-            data = s.to_dict()
-            file_path = data.get("file_path")
-            
-            if file_path:
-                # ESTRATEGIA PROXY RELATIVO + ANTI-CACHE QUERY PARAM
-                encoded_path = urllib.parse.quote(file_path)
-                # Agregamos &v=... para que la URL sea única en cada petición
-                data["file_url"] = f"/api/evidence/proxy?path={encoded_path}&v={ts}"
-            
-            rec_doc = db.collection("artifacts").document(APP_ID).collection("public").document("data").collection("recommendations").document(data['recommendation_id']).get()
-            if rec_doc.exists:
-                rec_info = rec_doc.to_dict()
-                data["display_id"] = rec_info.get("id", "S/N")
-                data["current_progress"] = rec_info.get("progress", 0)
-            
-            if "timestamp" in data and data["timestamp"]:
-                data["timestamp"] = data["timestamp"].isoformat()
-            results.append(data)
-            
-        # Headers anti-caché estrictos para el JSON de respuesta
-        return JSONResponse(
-            content=results,
-            headers={
-                "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
-                "Pragma": "no-cache",
-                "Expires": "0"
+    query = (
+        SUBS_COLL.where(filter=firestore.FieldFilter("status", "==", "PENDIENTE"))
+        .order_by("timestamp")
+        .select(SUBS_PENDING_FIELDS)
+        .limit(limit)
+    )
+    async with FIRESTORE_SEM:
+        if cursor:
+            cursor_doc = await SUBS_COLL.document(cursor).get()
+            if not cursor_doc.exists:
+                raise HTTPException(status_code=400, detail="Cursor inválido")
+            query = query.start_after(cursor_doc)
+        subs = [s.to_dict() async for s in query.stream()]
+
+        # Una sola lectura por lotes (BatchGetDocuments) en lugar de un get() por envío
+        rec_ids = {d["recommendation_id"] for d in subs if d.get("recommendation_id")}
+        rec_map = {}
+        if rec_ids:
+            rec_map = {
+                snap.id: snap.to_dict()
+                async for snap in db.get_all(
+                    [RECS_COLL.document(rid) for rid in rec_ids], field_paths=RECS_PENDING_FIELDS
+                )
+                if snap.exists
             }
-        )
-    except Exception as e:
-        logger.error(f"Error pendientes: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error de servidor")
 
-@app.post("/api/admin/approve")
-async def approve_submission(action: SubmissionAction, user=Depends(get_current_user)):
-    if not user["is_admin"]:
-        raise HTTPException(status_code=403)
-    try:
-        sub_ref = db.collection("artifacts").document(APP_ID).collection("submissions").document(action.submission_id)
-        sub_doc = sub_ref.get()
-        rec_id = sub_doc.to_dict().get("recommendation_id")
+    results = []
+    # Timestamp actual para romper caché en la URL
+    ts = int(time.time())
+
+    for data in subs:
+        file_path = data.get("file_path")
         
-        sub_ref.update({"status": "APROBADO"})
-        rec_ref = db.collection("artifacts").document(APP_ID).collection("public").document("data").collection("recommendations").document(rec_id)
-        rec_ref.update({
-            "progress": action.progress,
-            "status": "Completado" if action.progress >= 100 else "En Progreso",
-            "last_validated": firestore.SERVER_TIMESTAMP
-        })
-        return {"message": "Actualización exitosa"}
-    except Exception as e:
-        logger.error(f"Fallo aprobación: {str(e)}")
-        raise HTTPException(status_code=500, detail="Fallo de base de datos")
+        if file_path:
+            # ESTRATEGIA PROXY RELATIVO + ANTI-CACHE QUERY PARAM
+            encoded_path = urllib.parse.quote(file_path)
+            # Agregamos &v=... para que la URL sea única en cada petición
+            data["file_url"] = f"/api/evidence/proxy?path={encoded_path}&v={ts}"
+        
+        rec_info = rec_map.get(data.get("recommendation_id"))
+        if rec_info is not None:
+            data["display_id"] = rec_info.get("id", "S/N")
+            data["current_progress"] = rec_info.get("progress", 0)
+        
+        if "timestamp" in data and data["timestamp"]:
+            data["timestamp"] = data["timestamp"].isoformat()
+        results.append(data)
+        
+    # Página completa: puede haber más envíos después del último
+    next_cursor = results[-1]["id"] if len(results) == limit else None
 
-@app.get("/api/report/generate")
-async def generate_pdf(user=Depends(get_current_user)):
-    recs = db.collection("artifacts").document(APP_ID).collection("public").document("data").collection("recommendations").stream()
+    # Headers anti-caché estrictos para el JSON de respuesta
+    return OrjsonResponse(
+        content={"items": results, "next_cursor": next_cursor},
+        headers={
+            "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
+            "Pragma": "no-cache",
+            "Expires": "0"
+        }
+    )
+
+@app.post("/api/admin/approve")
+async def approve_submission(action: SubmissionAction, user=Depends(get_admin_user)):
+    sub_ref = SUBS_COLL.document(action.submission_id)
+    async with FIRESTORE_SEM:
+        sub_doc = await sub_ref.get()
+    rec_id = sub_doc.to_dict().get("recommendation_id")
+    
+    # Ambas actualizaciones en un solo commit: una RPC y sin estados a medio aplicar
+    batch = db.batch()
+    batch.update(sub_ref, {"status": "APROBADO"})
+    batch.update(RECS_COLL.document(rec_id), {
+        "progress": action.progress,
+        "status": "Completado" if action.progress >= 100 else "En Progreso",
+        "last_validated": firestore.SERVER_TIMESTAMP
+    })
+    async with FIRESTORE_SEM:
+        await batch.commit()
+    _recs_cache.clear()
+    return {"message": "Actualización exitosa"}
+
+@app.post("/api/admin/invalidate")
+async def invalidate_local_caches(user=Depends(get_admin_user)):
+    """
+    Descarta las cachés en memoria del worker que atiende la petición, no las
+    de todo el servicio: con varios workers o instancias, los demás siguen
+    sirviendo sus copias hasta que expiran (RECS_CACHE_TTL para recomendaciones
+    e informe, USER_CACHE_TTL para perfiles). Útil para ver de inmediato, en
+    esta sesión, un cambio hecho en la consola de Firestore.
+    """
+    _recs_cache.clear()
+    _user_cache.clear()
+    _unknown_user_cache.clear()
+    return {"message": "Cachés de este worker invalidadas", "pid": os.getpid()}
+
+def _sync_custom_claims(profiles: Dict[str, Dict[str, Any]]) -> int:
+    # Recorre las cuentas de Firebase Auth: los perfiles borrados de Firestore pierden sus claims
+    # Solo se tocan los CLAIM_FIELDS: cualquier otro claim de la cuenta se conserva
+    updated = 0
+    for account in auth.list_users().iterate_all():
+        profile = profiles.get(account.email)
+        current = account.custom_claims or {}
+        wanted = {f: profile[f] for f in CLAIM_FIELDS if profile.get(f) is not None} if profile else {}
+        if {f: current[f] for f in CLAIM_FIELDS if f in current} == wanted:
+            continue
+        claims = {k: v for k, v in current.items() if k not in CLAIM_FIELDS}
+        claims.update(wanted)
+        auth.set_custom_user_claims(account.uid, claims or None)
+        if any(f in current for f in CLAIM_FIELDS):
+            # Cambio o baja de un acceso ya otorgado: la sesión no puede renovarse con los claims viejos
+            auth.revoke_refresh_tokens(account.uid)
+        updated += 1
+    return updated
+
+@app.post("/api/admin/sync-claims")
+async def sync_custom_claims(user=Depends(get_admin_user)):
+    """
+    Copia rol e institución de cada perfil de Firestore a los custom claims
+    de Firebase. Los usuarios los reciben al renovar su token (máximo una hora).
+
+    Ventana de desfase aceptada: quien ya tiene claims de institución conserva ese
+    alcance de lectura hasta que su token vence (hasta una hora, más TOKEN_CACHE_TTL),
+    aunque su perfil cambie o se borre; /api/admin/invalidate no lo acorta. Por eso,
+    si cambia un acceso ya otorgado se revocan sus refresh tokens. El rol de
+    administrador no tiene ventana: user_from_token lo confirma siempre contra
+    Firestore, en todas las rutas (proxy, listado, /api/auth/me y administración).
+    """
+    async with FIRESTORE_SEM:
+        profiles = {doc.id: doc.to_dict() async for doc in USERS_COLL.select(list(CLAIM_FIELDS)).stream()}
+    updated = await run_in_threadpool(_sync_custom_claims, profiles)
+    return {"message": "Claims sincronizados", "updated": updated}
+
+# Versión del diseño del informe: subirla al cambiar build_report_pdf invalida los ETag
+# ya emitidos, aunque los datos no cambien
+REPORT_RENDER_VERSION = "2"
+
+def report_sort_key(rec: Dict[str, Any]):
+    value = rec.get("id")
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+def build_report_pdf(recs) -> bytes:
     buffer = io.BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
+    # Flujos de página comprimidos con zlib: el PDF se genera una vez por versión y se descarga muchas
+    p = canvas.Canvas(buffer, pagesize=letter, pageCompression=1)
     p.setFont("Helvetica-Bold", 14)
     p.drawString(100, 750, "INFORME TÉCNICO SPT")
+    # Un único objeto de texto por página (un bloque BT/ET) en lugar de uno por fila;
+    # el interlineado de 30 pt reemplaza el cálculo manual de coordenadas
+    text = p.beginText(100, 700)
+    text.setFont("Helvetica-Bold", 10, leading=30)
     y = 700
-    for doc in recs:
-        d = doc.to_dict()
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(100, y, f"[{d.get('id')}] {d.get('institution')} - {d.get('progress')}%")
+    # Orden estable por identificador visible, como order_by("id") en Firestore:
+    # los ids numéricos van antes que los de texto y se comparan como números
+    for d in sorted(recs, key=report_sort_key):
+        # El salto se decide antes de escribir la fila: nunca queda una página final vacía
+        if y < 100:
+            p.drawText(text)
+            p.showPage()
+            text = p.beginText(100, 750)
+            text.setFont("Helvetica-Bold", 10, leading=30)
+            y = 750
+        text.textLine(f"[{d.get('id')}] {d.get('institution')} - {d.get('progress')}%")
         y -= 30
-        if y < 100: p.showPage(); y = 750
+    p.drawText(text)
     p.save()
-    buffer.seek(0)
-    return StreamingResponse(buffer, media_type="application/pdf")
+    return buffer.getvalue()
+
+@app.get("/api/report/generate")
+async def generate_pdf(request: Request, user=Depends(get_current_user)):
+    entry = await _load_recommendations()
+    headers = cache_headers(entry["version"], f"pdf:{REPORT_RENDER_VERSION}")
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    # El informe usa un subconjunto de los campos ya cacheados para el listado
+    # y se genera una sola vez por versión de los datos
+    pdf = entry.get("pdf")
+    if pdf is None:
+        # El dibujo con ReportLab es bloqueante: fuera del event loop
+        pdf = await run_in_threadpool(build_report_pdf, entry["items"])
+        entry["pdf"] = pdf
+    # ReportLab serializa el documento completo en save(): no hay nada que transmitir
+    # por partes, así que se envía en un solo cuerpo con Content-Length
+    return Response(content=pdf, media_type="application/pdf", headers=headers)
 
 if os.path.exists("static"):
     app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# La página se lee una sola vez al arrancar; el ETag cambia con cada despliegue
+INDEX_HTML: Optional[bytes] = None
+if os.path.exists("static/index.html"):
+    with open("static/index.html", "rb") as f:
+        INDEX_HTML = f.read()
+else:
+    logger.error("static/index.html no existe: '/' responderá 404")
+INDEX_ETAG = f'"{hashlib.blake2b(INDEX_HTML or b"", digest_size=16).hexdigest()}"'
+
+INDEX_HEADERS = {"Cache-Control": "public, max-age=60, must-revalidate", "ETag": INDEX_ETAG}
+
 @app.get("/")
-async def serve_index():
-    return FileResponse("static/index.html")
+async def serve_index(request: Request):
+    if INDEX_HTML is None:
+        raise HTTPException(status_code=404, detail="Panel no disponible")
+    # Pasado max-age el navegador revalida: sin cambios recibe un 304 sin cuerpo
+    return not_modified(request, INDEX_HEADERS) or Response(
+        content=INDEX_HTML, media_type="text/html", headers=INDEX_HEADERS
+    )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+    # Con varios workers uvicorn necesita la app como cadena de importación
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8080)),
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=30,
+        # Cloud Run ya registra cada petición: se evita una línea de log por request
+        access_log=False,
+    )